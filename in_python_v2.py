@@ -3,10 +3,155 @@ import pygame.gfxdraw
 from pygame.locals import *
 from OpenGL.GL import *
 from OpenGL.GLU import *
+from OpenGL import error as gl_error
+import argparse
 import math
 import sys
+import time
 import numpy as np
 
+# Shadow shaders (GLSL 1.20 so the fixed-function matrices and light state stay usable)
+SHADOW_VERTEX_SHADER = """
+#version 120
+uniform mat4 inv_view;
+uniform mat4 static_shadow_matrix;
+uniform mat4 dynamic_shadow_matrix;
+varying vec3 world_normal;
+varying vec4 static_shadow_coord;
+varying vec4 dynamic_shadow_coord;
+varying vec4 base_color;
+void main() {
+    vec4 world_pos = inv_view * (gl_ModelViewMatrix * gl_Vertex);
+    world_normal = mat3(inv_view) * (gl_NormalMatrix * gl_Normal);
+    static_shadow_coord = static_shadow_matrix * world_pos;
+    dynamic_shadow_coord = dynamic_shadow_matrix * world_pos;
+    base_color = gl_Color;
+    gl_Position = ftransform();
+}
+"""
+
+SHADOW_FRAGMENT_SHADER = """
+#version 120
+uniform sampler2DShadow static_shadow_map;
+uniform sampler2DShadow dynamic_shadow_map;
+uniform bool use_dynamic;
+uniform vec3 sun_direction;
+uniform float shadow_ambient;
+varying vec3 world_normal;
+varying vec4 static_shadow_coord;
+varying vec4 dynamic_shadow_coord;
+varying vec4 base_color;
+void main() {
+    float lit = shadow2DProj(static_shadow_map, static_shadow_coord).r;
+    if (use_dynamic) {
+        lit *= shadow2DProj(dynamic_shadow_map, dynamic_shadow_coord).r;
+    }
+    float diffuse = max(dot(normalize(world_normal), sun_direction), 0.0);
+    vec3 ambient = (gl_LightModel.ambient.rgb + gl_LightSource[0].ambient.rgb) * base_color.rgb;
+    vec3 sun = gl_LightSource[0].diffuse.rgb * base_color.rgb * diffuse * mix(shadow_ambient, 1.0, lit);
+    gl_FragColor = vec4(ambient + sun, base_color.a);
+}
+"""
+
+# Maps light clip space [-1, 1] to shadow texture space [0, 1]
+SHADOW_BIAS_MATRIX = np.array([
+    [0.5, 0.0, 0.0, 0.5],
+    [0.0, 0.5, 0.0, 0.5],
+    [0.0, 0.0, 0.5, 0.5],
+    [0.0, 0.0, 0.0, 1.0]
+], dtype=np.float32)
+
+# Fixed layout of one simulation tick, so snapshots are a few array writes instead of deep copies
+SIMULATION_STATE_DTYPE = np.dtype([
+    ('tick', np.int64),
+    ('dt', np.float64),
+    # Physics state
+    ('position', np.float64, 3),
+    ('velocity', np.float64, 3),
+    ('physics_flags', np.uint8),   # STATE_JUMPING | STATE_ON_FLOOR
+    # Inputs applied during the tick
+    ('pitch', np.float64),
+    ('yaw', np.float64),
+    ('input_flags', np.uint8),     # INPUT_* bits
+    # Runtime-editable config
+    ('wall_colors', np.float64, (4, 3)),
+    ('floor_color', np.float64, 3),
+    ('ceiling_color', np.float64, 3),
+    ('ambient', np.float64),
+    ('sun_intensity', np.float64),
+    ('sun_position', np.float64, 3)
+])
+
+STATE_JUMPING = 1
+STATE_ON_FLOOR = 2
+
+INPUT_FORWARD = 1
+INPUT_BACKWARD = 2
+INPUT_LEFT = 4
+INPUT_RIGHT = 8
+INPUT_JUMP = 16
+INPUT_MOUSE_LOCKED = 32
+INPUT_RESET = 64
+
+MOVE_INPUTS = (
+    ('forward', INPUT_FORWARD),
+    ('backward', INPUT_BACKWARD),
+    ('left', INPUT_LEFT),
+    ('right', INPUT_RIGHT)
+)
+
+WALL_NAMES = ('front', 'back', 'left', 'right')
+
+# Furniture sizes (width, height, depth); colors come from config['colors']['furniture']
+FURNITURE_ARCHETYPES = {
+    'table': (3, 0.6, 1.5),
+    'chair': (0.6, 1.2, 0.6),
+    'bed': (4, 0.6, 2.5),
+    'bookshelf': (0.4, 4, 3)
+}
+
+# Gap kept between the player and a surface after a contact, so sliding doesn't re-hit it
+COLLISION_SKIN = 1e-4
+
+def look_at_matrix(eye, target, up):
+    forward = target - eye
+    forward /= np.linalg.norm(forward)
+    side = np.cross(forward, up)
+    side /= np.linalg.norm(side)
+    true_up = np.cross(side, forward)
+    
+    matrix = np.identity(4, dtype=np.float32)
+    matrix[0, :3] = side
+    matrix[1, :3] = true_up
+    matrix[2, :3] = -forward
+    matrix[:3, 3] = -matrix[:3, :3] @ eye
+    return matrix
+
+def orthographic_matrix(left, right, bottom, top, near, far):
+    matrix = np.identity(4, dtype=np.float32)
+    matrix[0, 0] = 2 / (right - left)
+    matrix[1, 1] = 2 / (top - bottom)
+    matrix[2, 2] = -2 / (far - near)
+    matrix[0, 3] = -(right + left) / (right - left)
+    matrix[1, 3] = -(top + bottom) / (top - bottom)
+    matrix[2, 3] = -(far + near) / (far - near)
+    return matrix
+
+def compile_shader_program(vertex_source, fragment_source):
+    program = glCreateProgram()
+    for source, shader_type in ((vertex_source, GL_VERTEX_SHADER), (fragment_source, GL_FRAGMENT_SHADER)):
+        shader = glCreateShader(shader_type)
+        glShaderSource(shader, source)
+        glCompileShader(shader)
+        if not glGetShaderiv(shader, GL_COMPILE_STATUS):
+            raise RuntimeError(glGetShaderInfoLog(shader))
+        glAttachShader(program, shader)
+        glDeleteShader(shader)
+    glLinkProgram(program)
+    if not glGetProgramiv(program, GL_LINK_STATUS):
+        raise RuntimeError(glGetProgramInfoLog(program))
+    return program
+
 class Vector3:
     def __init__(self, x=0, y=0, z=0):
         self.x = x
@@ -72,6 +217,80 @@ class Camera:
         glRotatef(math.degrees(-self.yaw), 0, 1, 0)
         glTranslatef(-self.position.x, -self.position.y, -self.position.z)
 
+class StateHistory:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.states = np.zeros(capacity, dtype=SIMULATION_STATE_DTYPE)
+        self.states['tick'] = -1
+        self.latest = -1
+    
+    def slot(self, tick):
+        # Structured scalars are views, so writes go straight into the buffer
+        record = self.states[tick % self.capacity]
+        record['tick'] = tick
+        self.latest = tick
+        return record
+    
+    def get(self, tick):
+        record = self.states[tick % self.capacity]
+        if tick < 0 or tick > self.latest or record['tick'] != tick:
+            raise ValueError(f"Tick {tick} is not in the last {self.capacity} snapshots")
+        return record
+    
+    def discard_after(self, tick):
+        # Snapshots after `tick` belong to a timeline abandoned by a restore
+        self.latest = min(self.latest, tick)
+
+def generate_scene(object_count, density=0.5, seed=0, clearance=1.0):
+    # Every piece gets its own grid cell, sized so the largest archetype plus `clearance` fits
+    # in either orientation. Pieces can't overlap and always leave a walkable gap, so every
+    # free spot is reachable. `density` is the fraction of cells that get furniture.
+    if object_count < 0:
+        raise ValueError("object_count must be >= 0")
+    if not 0 < density <= 1:
+        raise ValueError("density must be in (0, 1]")
+    if clearance < 0.9:
+        # Player width (0.8) plus half a wall (0.1), or the gaps stop being walkable
+        raise ValueError("clearance must be >= 0.9")
+    
+    rng = np.random.default_rng(seed)
+    types = list(FURNITURE_ARCHETYPES)
+    sizes = np.array([FURNITURE_ARCHETYPES[name] for name in types], dtype=np.float64)
+    cell = sizes[:, [0, 2]].max() + clearance
+    
+    # Room grows with the object count; the extra cells make up for candidates rejected below
+    cell_count = math.ceil(object_count / density) + 4
+    columns = math.ceil(math.sqrt(cell_count))
+    rows = math.ceil(cell_count / columns)
+    width = columns * cell + clearance
+    depth = rows * cell + clearance
+    
+    # Random cells, archetypes, quarter-turns and jitter for all candidates at once
+    candidates = min(object_count + 4, columns * rows)
+    cells = rng.choice(columns * rows, size=candidates, replace=False)
+    kinds = rng.integers(len(types), size=candidates)
+    footprints = sizes[kinds][:, [0, 2]]
+    rotated = rng.random(candidates) < 0.5
+    footprints[rotated] = footprints[rotated][:, ::-1]
+    # Clamped because the widest archetype's slack can round to just below zero
+    slack = np.maximum((cell - clearance - footprints) / 2, 0)
+    offsets = rng.uniform(-slack, slack)
+    
+    x = -width/2 + clearance/2 + (cells % columns + 0.5) * cell + offsets[:, 0]
+    z = -depth/2 + clearance/2 + (cells // columns + 0.5) * cell + offsets[:, 1]
+    
+    # Reject anything that would block the spawn point at the room centre
+    reach = footprints / 2 + clearance
+    blocks_spawn = (np.abs(x) < reach[:, 0]) & (np.abs(z) < reach[:, 1])
+    keep = np.flatnonzero(~blocks_spawn)[:object_count]
+    
+    furniture = [
+        {'type': types[kind], 'pos': Vector3(px, 0, pz), 'size': Vector3(sx, sizes[kind, 1], sz)}
+        for kind, px, pz, sx, sz in zip(kinds[keep].tolist(), x[keep].tolist(), z[keep].tolist(),
+                                        footprints[keep, 0].tolist(), footprints[keep, 1].tolist())
+    ]
+    return {'width': width, 'depth': depth, 'furniture': furniture}
+
 class RoomSimulator:
     def __init__(self):
         # Configuration
@@ -95,7 +314,8 @@ class RoomSimulator:
                 'furniture': {
                     'table': [0.55, 0.27, 0.075],
                     'chair': [0.63, 0.32, 0.18],
-                    'bed': [0.28, 0.51, 0.71]
+                    'bed': [0.28, 0.51, 0.71],
+                    'bookshelf': [0.55, 0.27, 0.075]
                 }
             },
             'lighting': {
@@ -103,6 +323,13 @@ class RoomSimulator:
                 'sun_intensity': 0.8,
                 'sun_position': [5, 10, 5],
                 'room_light': 0.6
+            },
+            'collision_iterations': 3,
+            'history_size': 600,
+            'shadows': {
+                'enabled': True,
+                'map_size': 2048,
+                'ambient': 0.35
             }
         }
         
@@ -116,7 +343,15 @@ class RoomSimulator:
         }
         self.is_jumping = False
         self.is_on_floor = False
+        self.jump_requested = False
+        self.reset_requested = False
+        self.tick = 0
+        self.history = StateHistory(self.config['history_size'])
         self.walls = []
+        self.furniture = []
+        self.dynamic_casters = []  # {'pos', 'size', 'color'} dicts, see add_dynamic_caster
+        self.scene_version = 0
+        self.collider_version = -1
         self.mouse_locked = False
         self.clock = pygame.time.Clock()
         # self.keys = pygame.key.get_pressed()  # ❌ Removed this line
@@ -146,6 +381,23 @@ class RoomSimulator:
         self.create_room()
         self.create_furniture()
         
+        # Set up shadow maps (static casters are cached, dynamic ones redrawn per frame)
+        self.shadow_stats = {
+            'static_regenerations': 0,
+            'static_time': 0.0,
+            'dynamic_regenerations': 0,
+            'dynamic_time': 0.0
+        }
+        self.static_shadow_key = None
+        self.shadow_program = None
+        if self.config['shadows']['enabled']:
+            try:
+                self.setup_shadows()
+            except (RuntimeError, gl_error.Error) as e:
+                # Old drivers without shaders/FBOs still get the plain fixed-function scene
+                print(f"Shadows disabled: {e}")
+                self.shadow_program = None
+        
         # Show instructions
         print("=== 3D Room Simulator ===")
         print("Controls:")
@@ -158,6 +410,7 @@ class RoomSimulator:
         print("R: Reset position")
         print("1-4: Change wall colors")
         print("5-6: Adjust lighting")
+        print("M: Print shadow metrics")
         print("========================")
     
     def setup_lighting(self):
@@ -183,6 +436,148 @@ class RoomSimulator:
         glEnable(GL_LIGHTING)
         glEnable(GL_LIGHT0)
     
+    def setup_shadows(self):
+        size = self.config['shadows']['map_size']
+        self.shadow_maps = {}
+        for name in ('static', 'dynamic'):
+            texture = glGenTextures(1)
+            glBindTexture(GL_TEXTURE_2D, texture)
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_DEPTH_COMPONENT24, size, size, 0,
+                         GL_DEPTH_COMPONENT, GL_FLOAT, None)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_BORDER)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_BORDER)
+            glTexParameterfv(GL_TEXTURE_2D, GL_TEXTURE_BORDER_COLOR, [1.0, 1.0, 1.0, 1.0])
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_COMPARE_MODE, GL_COMPARE_R_TO_TEXTURE)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_COMPARE_FUNC, GL_LEQUAL)
+            
+            framebuffer = glGenFramebuffers(1)
+            glBindFramebuffer(GL_FRAMEBUFFER, framebuffer)
+            glFramebufferTexture2D(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_TEXTURE_2D, texture, 0)
+            glDrawBuffer(GL_NONE)
+            glReadBuffer(GL_NONE)
+            if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+                glBindFramebuffer(GL_FRAMEBUFFER, 0)
+                raise RuntimeError("shadow map framebuffer is incomplete")
+            
+            self.shadow_maps[name] = {
+                'texture': texture,
+                'framebuffer': framebuffer,
+                'matrix': np.identity(4, dtype=np.float32)
+            }
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        
+        program = compile_shader_program(SHADOW_VERTEX_SHADER, SHADOW_FRAGMENT_SHADER)
+        self.shadow_uniforms = {
+            name: glGetUniformLocation(program, name)
+            for name in ('inv_view', 'static_shadow_matrix', 'dynamic_shadow_matrix',
+                         'static_shadow_map', 'dynamic_shadow_map', 'use_dynamic',
+                         'sun_direction', 'shadow_ambient')
+        }
+        self.shadow_program = program
+    
+    def get_sun_direction(self):
+        direction = np.array(self.config['lighting']['sun_position'], dtype=np.float32)
+        return direction / np.linalg.norm(direction)
+    
+    def compute_light_matrices(self):
+        w, h, d = (self.config['room_size']['width'], 
+                  self.config['room_size']['height'], 
+                  self.config['room_size']['depth'])
+        
+        # Orthographic box around the whole room, looking along the sun direction
+        direction = self.get_sun_direction()
+        center = np.array([0, h/2, 0], dtype=np.float32)
+        radius = math.sqrt(w**2 + h**2 + d**2) / 2
+        up = np.array([0, 1, 0] if abs(direction[1]) < 0.99 else [0, 0, 1], dtype=np.float32)
+        
+        view = look_at_matrix(center + direction * radius, center, up)
+        projection = orthographic_matrix(-radius, radius, -radius, radius, 0.0, radius * 2)
+        return view, projection
+    
+    def render_shadow_map(self, name, casters):
+        shadow_map = self.shadow_maps[name]
+        size = self.config['shadows']['map_size']
+        view, projection = self.light_matrices
+        viewport = glGetIntegerv(GL_VIEWPORT)
+        
+        glBindFramebuffer(GL_FRAMEBUFFER, shadow_map['framebuffer'])
+        glViewport(0, 0, size, size)
+        glClear(GL_DEPTH_BUFFER_BIT)
+        glColorMask(GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE)
+        glDisable(GL_LIGHTING)
+        glEnable(GL_POLYGON_OFFSET_FILL)
+        glPolygonOffset(2.0, 4.0)
+        
+        glMatrixMode(GL_PROJECTION)
+        glPushMatrix()
+        glLoadMatrixf(projection.T)
+        glMatrixMode(GL_MODELVIEW)
+        glPushMatrix()
+        glLoadMatrixf(view.T)
+        
+        for caster in casters:
+            self.draw_cube(caster['pos'], caster['size'], [1.0, 1.0, 1.0])
+        
+        glPopMatrix()
+        glMatrixMode(GL_PROJECTION)
+        glPopMatrix()
+        glMatrixMode(GL_MODELVIEW)
+        
+        glDisable(GL_POLYGON_OFFSET_FILL)
+        glEnable(GL_LIGHTING)
+        glColorMask(GL_TRUE, GL_TRUE, GL_TRUE, GL_TRUE)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        glViewport(*viewport)
+        
+        shadow_map['matrix'] = SHADOW_BIAS_MATRIX @ projection @ view
+    
+    def update_shadow_maps(self):
+        # The static map is only redrawn when the sun, the room or the furniture changed
+        key = (tuple(self.config['lighting']['sun_position']),
+               tuple(self.config['room_size'].values()),
+               self.scene_version)
+        if key != self.static_shadow_key:
+            start = time.perf_counter()
+            self.light_matrices = self.compute_light_matrices()
+            self.render_shadow_map('static', self.furniture)
+            self.static_shadow_key = key
+            self.shadow_stats['static_regenerations'] += 1
+            self.shadow_stats['static_time'] += time.perf_counter() - start
+        
+        # Moving objects go in their own small map so they never invalidate the static one
+        if self.dynamic_casters:
+            start = time.perf_counter()
+            self.render_shadow_map('dynamic', self.dynamic_casters)
+            self.shadow_stats['dynamic_regenerations'] += 1
+            self.shadow_stats['dynamic_time'] += time.perf_counter() - start
+    
+    def bind_shadow_program(self):
+        # Called with the camera view loaded, so world positions can be recovered in the shader
+        view = np.array(glGetFloatv(GL_MODELVIEW_MATRIX), dtype=np.float32).reshape(4, 4).T
+        inv_view = np.ascontiguousarray(np.linalg.inv(view), dtype=np.float32)
+        uniforms = self.shadow_uniforms
+        
+        glUseProgram(self.shadow_program)
+        glUniformMatrix4fv(uniforms['inv_view'], 1, GL_TRUE, inv_view)
+        glUniformMatrix4fv(uniforms['static_shadow_matrix'], 1, GL_TRUE,
+                           np.ascontiguousarray(self.shadow_maps['static']['matrix']))
+        glUniformMatrix4fv(uniforms['dynamic_shadow_matrix'], 1, GL_TRUE,
+                           np.ascontiguousarray(self.shadow_maps['dynamic']['matrix']))
+        glUniform1i(uniforms['use_dynamic'], int(bool(self.dynamic_casters)))
+        glUniform3f(uniforms['sun_direction'], *self.get_sun_direction())
+        glUniform1f(uniforms['shadow_ambient'], self.config['shadows']['ambient'])
+        
+        glActiveTexture(GL_TEXTURE0)
+        glBindTexture(GL_TEXTURE_2D, self.shadow_maps['static']['texture'])
+        glUniform1i(uniforms['static_shadow_map'], 0)
+        glActiveTexture(GL_TEXTURE1)
+        glBindTexture(GL_TEXTURE_2D, self.shadow_maps['dynamic']['texture'])
+        glUniform1i(uniforms['dynamic_shadow_map'], 1)
+        glActiveTexture(GL_TEXTURE0)
+    
     def create_room(self):
         w, h, d = (self.config['room_size']['width'], 
                   self.config['room_size']['height'], 
@@ -199,40 +594,51 @@ class RoomSimulator:
             # Right wall
             {'pos': Vector3(w/2, 0, 0), 'size': Vector3(0.2, h, d), 'rotation': 0}
         ]
+        self.mark_scene_changed()
     
     def create_furniture(self):
-        # Table
-        self.walls.append({
-            'pos': Vector3(0, 0, -4),
-            'size': Vector3(3, 0.6, 1.5),
-            'rotation': 0
-        })
-        
-        # Chairs
-        self.walls.append({
-            'pos': Vector3(-1, 0, -2.5),
-            'size': Vector3(0.6, 1.2, 0.6),
-            'rotation': 0
-        })
-        self.walls.append({
-            'pos': Vector3(1, 0, -2.5),
-            'size': Vector3(0.6, 1.2, 0.6),
-            'rotation': 0
-        })
-        
-        # Bed
-        self.walls.append({
-            'pos': Vector3(-4, 0, 4),
-            'size': Vector3(4, 0.6, 2.5),
-            'rotation': 0
-        })
-        
-        # Bookshelf
-        self.walls.append({
-            'pos': Vector3(6, 0, 0),
-            'size': Vector3(0.4, 4, 3),
-            'rotation': 0
-        })
+        self.set_furniture([
+            # Table
+            {'type': 'table', 'pos': Vector3(0, 0, -4), 'size': Vector3(*FURNITURE_ARCHETYPES['table'])},
+            # Chairs
+            {'type': 'chair', 'pos': Vector3(-1, 0, -2.5), 'size': Vector3(*FURNITURE_ARCHETYPES['chair'])},
+            {'type': 'chair', 'pos': Vector3(1, 0, -2.5), 'size': Vector3(*FURNITURE_ARCHETYPES['chair'])},
+            # Bed
+            {'type': 'bed', 'pos': Vector3(-4, 0, 4), 'size': Vector3(*FURNITURE_ARCHETYPES['bed'])},
+            # Bookshelf
+            {'type': 'bookshelf', 'pos': Vector3(6, 0, 0), 'size': Vector3(*FURNITURE_ARCHETYPES['bookshelf'])}
+        ])
+    
+    def set_furniture(self, furniture):
+        # Rebuilds the colliders from the room walls so old furniture doesn't linger
+        self.create_room()
+        self.furniture = furniture
+        
+        # Furniture pieces are colliders too
+        for item in self.furniture:
+            self.walls.append({'pos': item['pos'], 'size': item['size'], 'rotation': 0})
+        
+        self.mark_scene_changed()
+    
+    def add_dynamic_caster(self, pos, size, color):
+        # Moving objects: drawn every frame and kept in their own shadow map, so moving them
+        # (by editing caster['pos'] / caster['size']) never rebuilds the static one
+        caster = {'pos': pos, 'size': size, 'color': color}
+        self.dynamic_casters.append(caster)
+        return caster
+    
+    def remove_dynamic_caster(self, caster):
+        self.dynamic_casters.remove(caster)
+    
+    def load_scene(self, scene):
+        # Replaces the room and furniture with one from generate_scene
+        self.config['room_size']['width'] = scene['width']
+        self.config['room_size']['depth'] = scene['depth']
+        self.set_furniture(scene['furniture'])
+    
+    def mark_scene_changed(self):
+        # Call after editing walls/furniture so the cached static shadow map is rebuilt
+        self.scene_version += 1
     
     def draw_cube(self, pos, size, color):
         glColor3f(*color)
@@ -332,12 +738,18 @@ class RoomSimulator:
         glPopMatrix()
     
     def render(self):
+        if self.shadow_program:
+            self.update_shadow_maps()
+        
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
         glLoadIdentity()
         
         # Apply camera
         self.camera.apply_view_matrix()
         
+        if self.shadow_program:
+            self.bind_shadow_program()
+        
         # Draw room
         w, h, d = (self.config['room_size']['width'], 
                   self.config['room_size']['height'], 
@@ -360,54 +772,147 @@ class RoomSimulator:
         
         # Furniture
         furniture_colors = self.config['colors']['furniture']
+        for item in self.furniture:
+            self.draw_cube(item['pos'], item['size'], furniture_colors[item['type']])
         
-        # Table
-        self.draw_cube(Vector3(0, 0, -4), Vector3(3, 0.6, 1.5), furniture_colors['table'])
+        # Moving objects
+        for caster in self.dynamic_casters:
+            self.draw_cube(caster['pos'], caster['size'], caster['color'])
         
-        # Chairs
-        self.draw_cube(Vector3(-1, 0, -2.5), Vector3(0.6, 1.2, 0.6), furniture_colors['chair'])
-        self.draw_cube(Vector3(1, 0, -2.5), Vector3(0.6, 1.2, 0.6), furniture_colors['chair'])
+        if self.shadow_program:
+            glUseProgram(0)
+        
+        pygame.display.flip()
+    
+    def get_collider_bounds(self):
+        # Walls as (N, 3) min/max arrays, rebuilt only when the scene changes
+        if self.collider_version != self.scene_version:
+            positions = np.array([(w['pos'].x, w['pos'].y, w['pos'].z) for w in self.walls], dtype=np.float64)
+            sizes = np.array([(w['size'].x, w['size'].y, w['size'].z) for w in self.walls], dtype=np.float64)
+            positions = positions.reshape(-1, 3)
+            sizes = sizes.reshape(-1, 3)
+            
+            # Colliders sit on pos.y and are centred on x/z
+            collider_min = positions - sizes * [0.5, 0.0, 0.5]
+            collider_max = positions + sizes * [0.5, 1.0, 0.5]
+            
+            # Floor and ceiling slabs, so a large step can't carry the sweep under or over the walls
+            w, h, d = (self.config['room_size']['width'], 
+                      self.config['room_size']['height'], 
+                      self.config['room_size']['depth'])
+            slab_min = [[-w/2, -1, -d/2], [-w/2, h - 0.1, -d/2]]
+            slab_max = [[w/2, 0, d/2], [w/2, h + 1, d/2]]
+            
+            self.collider_min = np.vstack([collider_min, slab_min])
+            self.collider_max = np.vstack([collider_max, slab_max])
+            self.collider_version = self.scene_version
+        return self.collider_min, self.collider_max
+    
+    def get_player_extents(self, pos):
+        # Player box centre and half size; pos is the eye position at the top of the box
+        half = np.array([self.config['player_radius'],
+                         self.config['player_height'] / 2,
+                         self.config['player_radius']])
+        center = np.array([pos.x, pos.y - half[1], pos.z])
+        return center, half
+    
+    def resolve_penetration(self, center, expanded_min, expanded_max):
+        # The sweep only sees surfaces ahead of the player, so push out of anything we
+        # already start inside, along the axis of least penetration
+        inside = np.all((center > expanded_min) & (center < expanded_max), axis=1)
+        for index in np.flatnonzero(inside):
+            below = center - expanded_min[index]
+            above = expanded_max[index] - center
+            if not np.all((below > 0) & (above > 0)):
+                continue  # An earlier push already moved us out of this one
+            depth = np.minimum(below, above)
+            axis = int(np.argmin(depth))
+            if below[axis] < above[axis]:
+                center[axis] = expanded_min[index, axis] - COLLISION_SKIN
+            else:
+                center[axis] = expanded_max[index, axis] + COLLISION_SKIN
+    
+    def sweep_colliders(self, center, displacement, expanded_min, expanded_max):
+        # Ray vs. Minkowski-expanded boxes: returns the earliest time of impact in [0, 1)
+        # along `displacement` and the contact normal, or (1.0, None) if the path is clear
+        moving = displacement != 0
+        inverse = np.divide(1.0, displacement, out=np.zeros(3), where=moving)
+        t1 = (expanded_min - center) * inverse
+        t2 = (expanded_max - center) * inverse
+        t_near = np.minimum(t1, t2)
+        t_far = np.maximum(t1, t2)
         
-        # Bed
-        self.draw_cube(Vector3(-4, 0, 4), Vector3(4, 0.6, 2.5), furniture_colors['bed'])
+        # Axes we don't move along only matter if we're already within that slab
+        inside = (center > expanded_min) & (center < expanded_max)
+        t_near = np.where(moving, t_near, np.where(inside, -np.inf, np.inf))
+        t_far = np.where(moving, t_far, np.where(inside, np.inf, -np.inf))
         
-        # Bookshelf
-        self.draw_cube(Vector3(6, 0, 0), Vector3(0.4, 4, 3), [0.55, 0.27, 0.075])
+        t_enter = t_near.max(axis=1)
+        t_exit = t_far.min(axis=1)
+        hits = (t_enter <= t_exit) & (t_enter >= 0) & (t_enter < 1)
+        if not hits.any():
+            return 1.0, None
         
-        pygame.display.flip()
+        candidates = np.flatnonzero(hits)
+        first = candidates[np.argmin(t_enter[candidates])]
+        axis = int(np.argmax(t_near[first]))
+        normal = np.zeros(3)
+        normal[axis] = -np.sign(displacement[axis])
+        return float(t_enter[first]), normal
     
-    def check_collision(self, new_pos):
-        for wall in self.walls:
-            # Simple AABB collision detection
-            wall_min = Vector3(
-                wall['pos'].x - wall['size'].x/2,
-                wall['pos'].y,
-                wall['pos'].z - wall['size'].z/2
-            )
-            wall_max = Vector3(
-                wall['pos'].x + wall['size'].x/2,
-                wall['pos'].y + wall['size'].y,
-                wall['pos'].z + wall['size'].z/2
-            )
+    def move_and_slide(self, dt):
+        center, half = self.get_player_extents(self.camera.position)
+        velocity = np.array([self.velocity.x, self.velocity.y, self.velocity.z])
+        remaining = velocity * dt
+        
+        collider_min, collider_max = self.get_collider_bounds()
+        expanded_min = collider_min - half
+        expanded_max = collider_max + half
+        self.resolve_penetration(center, expanded_min, expanded_max)
+        
+        # One broad-phase pass: keep only colliders the whole swept box can reach
+        swept_min = np.minimum(center, center + remaining) - COLLISION_SKIN
+        swept_max = np.maximum(center, center + remaining) + COLLISION_SKIN
+        nearby = np.all((expanded_min < swept_max) & (expanded_max > swept_min), axis=1)
+        expanded_min = expanded_min[nearby]
+        expanded_max = expanded_max[nearby]
+        
+        for _ in range(self.config['collision_iterations']):
+            toi, normal = self.sweep_colliders(center, remaining, expanded_min, expanded_max)
+            if normal is None:
+                center += remaining
+                break
             
-            player_min = Vector3(
-                new_pos.x - self.config['player_radius'],
-                new_pos.y - self.config['player_height'],
-                new_pos.z - self.config['player_radius']
-            )
-            player_max = Vector3(
-                new_pos.x + self.config['player_radius'],
-                new_pos.y,
-                new_pos.z + self.config['player_radius']
-            )
+            # Advance to the contact, then slide what's left along the contact plane
+            center += remaining * toi + normal * COLLISION_SKIN
+            remaining *= 1 - toi
+            remaining -= normal * remaining.dot(normal)
+            velocity -= normal * velocity.dot(normal)
             
-            if (player_min.x < wall_max.x and player_max.x > wall_min.x and
-                player_min.y < wall_max.y and player_max.y > wall_min.y and
-                player_min.z < wall_max.z and player_max.z > wall_min.z):
-                return True
-        return False
+            if normal[1] > 0:
+                # Landed on top of something
+                self.is_jumping = False
+                self.is_on_floor = True
+        
+        self.camera.position = Vector3(float(center[0]), float(center[1] + half[1]), float(center[2]))
+        self.velocity = Vector3(*velocity.tolist())
     
     def update_movement(self, dt):
+        # Resets and jumps are applied here rather than in handle_events so replays reproduce them
+        if self.reset_requested:
+            self.reset_requested = False
+            self.camera.position = Vector3(0, 1.7, 0)
+            self.camera.pitch = 0
+            self.camera.yaw = 0
+            self.velocity = Vector3(0, 0, 0)
+        
+        jump_requested = self.jump_requested
+        self.jump_requested = False
+        if jump_requested and not self.is_jumping and self.is_on_floor:
+            self.velocity.y = self.config['jump_height']
+            self.is_jumping = True
+            self.is_on_floor = False
+        
         if not self.mouse_locked:
             return
         
@@ -437,26 +942,9 @@ class RoomSimulator:
         # Apply gravity
         self.velocity.y += self.config['gravity'] * dt
         
-        # Calculate new position
-        old_pos = Vector3(self.camera.position.x, self.camera.position.y, self.camera.position.z)
-        new_pos = Vector3(
-            old_pos.x + self.velocity.x * dt,
-            old_pos.y + self.velocity.y * dt,
-            old_pos.z + self.velocity.z * dt
-        )
-        
-        # Check collision and update position
-        if not self.check_collision(new_pos):
-            self.camera.position = new_pos
-        else:
-            # Try sliding along walls
-            new_x_pos = Vector3(old_pos.x + self.velocity.x * dt, new_pos.y, old_pos.z)
-            if not self.check_collision(new_x_pos):
-                self.camera.position.x = new_x_pos.x
-            
-            new_z_pos = Vector3(old_pos.x, new_pos.y, old_pos.z + self.velocity.z * dt)
-            if not self.check_collision(new_z_pos):
-                self.camera.position.z = new_z_pos.z
+        # Sweep against all colliders and slide along whatever we hit
+        self.is_on_floor = False
+        self.move_and_slide(dt)
         
         # Floor collision
         if self.camera.position.y <= self.config['player_height']:
@@ -470,6 +958,102 @@ class RoomSimulator:
             self.camera.position.y = self.config['room_size']['height'] - 0.1
             self.velocity.y = 0
     
+    def pack_physics_state(self, record):
+        position = self.camera.position
+        record['position'] = (position.x, position.y, position.z)
+        record['velocity'] = (self.velocity.x, self.velocity.y, self.velocity.z)
+        record['physics_flags'] = ((STATE_JUMPING if self.is_jumping else 0) |
+                                   (STATE_ON_FLOOR if self.is_on_floor else 0))
+    
+    def pack_state(self, record, dt):
+        record['dt'] = dt
+        self.pack_physics_state(record)
+        
+        record['pitch'] = self.camera.pitch
+        record['yaw'] = self.camera.yaw
+        input_flags = INPUT_JUMP if self.jump_requested else 0
+        if self.reset_requested:
+            input_flags |= INPUT_RESET
+        if self.mouse_locked:
+            input_flags |= INPUT_MOUSE_LOCKED
+        for name, bit in MOVE_INPUTS:
+            if self.move_direction[name]:
+                input_flags |= bit
+        record['input_flags'] = input_flags
+        
+        colors = self.config['colors']
+        lighting = self.config['lighting']
+        record['wall_colors'] = [colors['walls'][name] for name in WALL_NAMES]
+        record['floor_color'] = colors['floor']
+        record['ceiling_color'] = colors['ceiling']
+        record['ambient'] = lighting['ambient']
+        record['sun_intensity'] = lighting['sun_intensity']
+        record['sun_position'] = lighting['sun_position']
+    
+    def unpack_inputs(self, record):
+        self.camera.pitch = float(record['pitch'])
+        self.camera.yaw = float(record['yaw'])
+        input_flags = int(record['input_flags'])
+        self.jump_requested = bool(input_flags & INPUT_JUMP)
+        self.reset_requested = bool(input_flags & INPUT_RESET)
+        self.mouse_locked = bool(input_flags & INPUT_MOUSE_LOCKED)
+        for name, bit in MOVE_INPUTS:
+            self.move_direction[name] = bool(input_flags & bit)
+        
+        colors = self.config['colors']
+        lighting = self.config['lighting']
+        for name, color in zip(WALL_NAMES, record['wall_colors'].tolist()):
+            colors['walls'][name] = color
+        colors['floor'] = record['floor_color'].tolist()
+        colors['ceiling'] = record['ceiling_color'].tolist()
+        
+        # Only touch the GL light state when the lighting actually differs
+        ambient = float(record['ambient'])
+        sun_intensity = float(record['sun_intensity'])
+        sun_position = record['sun_position'].tolist()
+        if (lighting['ambient'], lighting['sun_intensity'], lighting['sun_position']) != \
+                (ambient, sun_intensity, sun_position):
+            lighting['ambient'] = ambient
+            lighting['sun_intensity'] = sun_intensity
+            lighting['sun_position'] = sun_position
+            self.setup_lighting()
+    
+    def unpack_state(self, record):
+        position = record['position']
+        velocity = record['velocity']
+        self.camera.position = Vector3(*position.tolist())
+        self.velocity = Vector3(*velocity.tolist())
+        physics_flags = int(record['physics_flags'])
+        self.is_jumping = bool(physics_flags & STATE_JUMPING)
+        self.is_on_floor = bool(physics_flags & STATE_ON_FLOOR)
+        self.unpack_inputs(record)
+    
+    def snapshot(self, dt):
+        # Records the state at the start of this tick together with the inputs it will apply
+        tick = self.tick
+        self.pack_state(self.history.slot(tick), dt)
+        self.tick += 1
+        return tick
+    
+    def restore(self, tick):
+        # Puts the simulation back to the start of `tick`; snapshots after it are discarded
+        self.unpack_state(self.history.get(tick))
+        self.history.discard_after(tick)
+        self.tick = tick
+    
+    def resimulate_from(self, tick):
+        # Replays the recorded inputs from `tick` up to the present, e.g. after correcting
+        # the state stored at `tick`. Snapshots along the way are rewritten with the new physics.
+        latest_tick = self.tick - 1
+        self.unpack_state(self.history.get(tick))
+        self.tick = tick
+        while self.tick <= latest_tick:
+            record = self.history.get(self.tick)
+            self.unpack_inputs(record)
+            self.pack_physics_state(record)
+            self.tick += 1
+            self.update_movement(float(record['dt']))
+    
     def handle_events(self):
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
@@ -482,15 +1066,9 @@ class RoomSimulator:
                     pygame.display.toggle_fullscreen()
                 elif event.key == pygame.K_r:
                     # Reset position
-                    self.camera.position = Vector3(0, 1.7, 0)
-                    self.camera.pitch = 0
-                    self.camera.yaw = 0
-                    self.velocity = Vector3(0, 0, 0)
+                    self.reset_requested = True
                 elif event.key == pygame.K_SPACE:
-                    if not self.is_jumping and self.is_on_floor:
-                        self.velocity.y = self.config['jump_height']
-                        self.is_jumping = True
-                        self.is_on_floor = False
+                    self.jump_requested = True
                 # Color changing keys
                 elif event.key == pygame.K_1:
                     self.config['colors']['walls']['front'] = [1.0, 0.0, 0.0]
@@ -506,6 +1084,12 @@ class RoomSimulator:
                 elif event.key == pygame.K_6:
                     self.config['lighting']['ambient'] = max(0.0, self.config['lighting']['ambient'] - 0.1)
                     self.setup_lighting()
+                elif event.key == pygame.K_m:
+                    stats = self.shadow_stats
+                    print(f"Shadows: static {stats['static_regenerations']} regens "
+                          f"({stats['static_time'] * 1000:.2f} ms), "
+                          f"dynamic {stats['dynamic_regenerations']} regens "
+                          f"({stats['dynamic_time'] * 1000:.2f} ms)")
             
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 if event.button == 1:  # Left click
@@ -533,6 +1117,7 @@ class RoomSimulator:
             dt = self.clock.tick(60) / 1000.0  # Convert to seconds
             
             running = self.handle_events()
+            self.snapshot(dt)
             self.update_movement(dt)
             self.render()
         
@@ -540,8 +1125,16 @@ class RoomSimulator:
         sys.exit()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="3D Room Simulator")
+    parser.add_argument('--objects', type=int, help="generate a room with this many pieces of furniture")
+    parser.add_argument('--density', type=float, default=0.5, help="fraction of floor cells to furnish")
+    parser.add_argument('--seed', type=int, default=0, help="random seed for the generated room")
+    args = parser.parse_args()
+    
     try:
         simulator = RoomSimulator()
+        if args.objects is not None:
+            simulator.load_scene(generate_scene(args.objects, args.density, args.seed))
         simulator.run()
     except KeyboardInterrupt:
         pygame.quit()